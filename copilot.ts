@@ -1032,6 +1032,7 @@ async function chatSendMessage(message: string): Promise<void> {
   }) + "\n");
 
   let respOffset = 0;
+  let editCount = 0;
   const start = Date.now();
   while (Date.now() - start < 120000) {
     await editor.delay(100);
@@ -1049,6 +1050,10 @@ async function chatSendMessage(message: string): Promise<void> {
       if (msg.type === "chunk") {
         chatState.streamingText += msg.content || "";
         chatRefreshBuffer();
+      } else if (msg.type === "edit") {
+        // hunks arrive as they close; they are applied together on "done"
+        editCount++;
+        editor.setStatus(`Copilot: ${editCount} edit${editCount !== 1 ? "s" : ""} proposed...`);
       } else if (msg.type === "done" || msg.type === "error") {
         if (msg.type === "error") chatState.streamingText = `Error: ${msg.content}`;
         chatState.history.push({ role: "assistant", text: chatState.streamingText });
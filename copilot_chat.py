@@ -3,13 +3,17 @@
 Copilot Chat - interactive terminal chat using GitHub Copilot Chat API
 Usage: python3 copilot_chat.py [--context-file <path>] [--cursor-line <n>] [--selection-file <path>]
 """
+import http.client
 import json
 import os
 import re
+import shutil
 import sys
+import tempfile
+import urllib.parse
 import urllib.request
-import urllib.error
 import argparse
+from collections.abc import Iterator
 
 # ── ANSI colors ───────────────────────────────────────────────────────────────
 RESET   = "\033[0m"
@@ -36,12 +40,24 @@ CHAT_URL  = "https://api.githubcopilot.com/chat/completions"
 
 _session_token: str | None = None
 _session_expires: float = 0.0
+_oauth_cache: tuple[int, str] | None = None  # (apps.json mtime_ns, oauth token)
+
+# ── Chat connection ───────────────────────────────────────────────────────────
+_CHAT_PARTS = urllib.parse.urlsplit(CHAT_URL)
+_chat_conn: http.client.HTTPSConnection | None = None  # kept alive between turns
+READ_SIZE = 16384  # one TLS record's worth per read
 
 def get_oauth_token() -> str:
+    global _oauth_cache
     try:
+        mtime = os.stat(APPS_JSON).st_mtime_ns
+        if _oauth_cache and _oauth_cache[0] == mtime:
+            return _oauth_cache[1]
         with open(APPS_JSON) as f:
             data = json.load(f)
-        return list(data.values())[0]["oauth_token"]
+        token = list(data.values())[0]["oauth_token"]
+        _oauth_cache = (mtime, token)
+        return token
     except Exception as e:
         print(f"{RED}Error reading auth: {e}{RESET}")
         sys.exit(1)
@@ -69,7 +85,58 @@ def get_session_token() -> str:
         sys.exit(1)
 
 # ── Chat ──────────────────────────────────────────────────────────────────────
+def open_chat_stream(body: bytes, headers: dict) -> http.client.HTTPResponse:
+    """POST to the chat endpoint, reusing the previous turn's connection when possible."""
+    global _chat_conn
+    if _chat_conn is None:
+        _chat_conn = http.client.HTTPSConnection(_CHAT_PARTS.netloc)
+    reused = _chat_conn.sock is not None
+    try:
+        _chat_conn.request("POST", _CHAT_PARTS.path, body=body, headers=headers)
+        return _chat_conn.getresponse()
+    except (http.client.RemoteDisconnected, ConnectionError):
+        _chat_conn.close()
+        if not reused:
+            raise
+    # The server dropped the idle connection; retry once on a fresh one
+    _chat_conn = http.client.HTTPSConnection(_CHAT_PARTS.netloc)
+    _chat_conn.request("POST", _CHAT_PARTS.path, body=body, headers=headers)
+    return _chat_conn.getresponse()
+
+_EVENT_END_RE = re.compile(rb"\r?\n\r?\n")
+
+class SSEParser:
+    """Incremental server-sent events parser: feed raw bytes, get each event's data field."""
+
+    def __init__(self) -> None:
+        self.buf = bytearray()
+
+    def feed(self, chunk: bytes) -> Iterator[str]:
+        self.buf += chunk
+        pos = 0
+        while (m := _EVENT_END_RE.search(self.buf, pos)) is not None:
+            event = bytes(self.buf[pos:m.start()])
+            pos = m.end()
+            if event.startswith(b"data:") and b"\n" not in event and b"\r" not in event:
+                # the usual one-line "data: {...}" event
+                yield event[5:].removeprefix(b" ").decode("utf-8")
+                continue
+            data_lines = [l[5:].removeprefix(b" ") for l in event.splitlines() if l.startswith(b"data:")]
+            if data_lines:
+                yield b"\n".join(data_lines).decode("utf-8")
+        del self.buf[:pos]
+
+def iter_sse_payloads(resp: http.client.HTTPResponse) -> Iterator[str]:
+    parser = SSEParser()
+    while chunk := resp.read1(READ_SIZE):
+        for payload in parser.feed(chunk):
+            if payload == "[DONE]":
+                resp.read()  # drain so the connection can be reused
+                return
+            yield payload
+
 def stream_chat(messages: list, model: str) -> str:
+    global _chat_conn
     token = get_session_token()
     body = json.dumps({
         "model": model,
@@ -78,66 +145,86 @@ def stream_chat(messages: list, model: str) -> str:
         "temperature": 0.1,
         "top_p": 1,
     }).encode()
-    req = urllib.request.Request(CHAT_URL, data=body, method="POST", headers={
+    headers = {
         "Authorization": f"Bearer {token}",
         "Content-Type": "application/json",
         "Accept": "application/json",
         "editor-version": "vscode/1.85.0",
         "editor-plugin-version": "copilot-chat/0.12.0",
         "Copilot-Integration-Id": "vscode-chat",
-    })
+    }
     full_response = ""
     try:
-        with urllib.request.urlopen(req) as resp:
-            for raw_line in resp:
-                line = raw_line.decode("utf-8").strip()
-                if not line.startswith("data: "):
+        resp = open_chat_stream(body, headers)
+        if resp.status != 200:
+            body_text = resp.read().decode()
+            print(f"\n{RED}HTTP {resp.status}: {body_text}{RESET}")
+            return full_response
+        for payload in iter_sse_payloads(resp):
+            try:
+                chunk = json.loads(payload)
+                choices = chunk.get("choices", [])
+                if not choices:
                     continue
-                payload = line[6:]
-                if payload == "[DONE]":
-                    break
-                try:
-                    chunk = json.loads(payload)
-                    choices = chunk.get("choices", [])
-                    if not choices:
-                        continue
-                    delta = choices[0]["delta"].get("content", "")
-                    if delta:
-                        full_response += delta
-                        sys.stdout.write(delta)
-                        sys.stdout.flush()
-                except (KeyError, json.JSONDecodeError):
-                    pass
-    except urllib.error.HTTPError as e:
-        body_text = e.read().decode()
-        print(f"\n{RED}HTTP {e.code}: {body_text}{RESET}")
+                delta = choices[0]["delta"].get("content", "")
+                if delta:
+                    full_response += delta
+                    sys.stdout.write(delta)
+                    sys.stdout.flush()
+            except (KeyError, json.JSONDecodeError):
+                pass
     except Exception as e:
         print(f"\n{RED}Error: {e}{RESET}")
+        if _chat_conn is not None:
+            _chat_conn.close()
+            _chat_conn = None
     return full_response
 
 # ── Code block extraction ─────────────────────────────────────────────────────
-def extract_code_blocks(text: str) -> list[tuple[str, str]]:
-    """Return list of (lang, code) from fenced code blocks."""
-    pattern = r"```(\w*)\n(.*?)```"
-    return re.findall(pattern, text, re.DOTALL)
+_CODE_RE = re.compile(r"```(\w*)\n(.*?)```", re.DOTALL)
+
+def largest_code_block(text: str) -> tuple[str, str] | None:
+    """Return (lang, code) of the largest fenced code block, or None."""
+    best = None
+    best_len = -1
+    for m in _CODE_RE.finditer(text):
+        n = m.end(2) - m.start(2)
+        if n > best_len:
+            best_len = n
+            best = m
+    return best.groups() if best else None
 
 def apply_to_file(context_file: str, code: str) -> bool:
-    """Write code to context_file. Returns True on success."""
+    """Atomically replace context_file with code. Returns True on success."""
+    # Write a sibling temp file and rename it over the target, so the editor's
+    # file watcher never sees a truncated or half-written file
+    target = os.path.realpath(context_file)
+    tmp = None
     try:
-        with open(context_file, "w") as f:
+        fd, tmp = tempfile.mkstemp(prefix=".copilot-", dir=os.path.dirname(target))
+        with os.fdopen(fd, "w") as f:
             f.write(code)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(target):
+            shutil.copymode(target, tmp)
+        os.replace(tmp, target)
         return True
     except Exception as e:
+        if tmp:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
         print(f"{RED}Failed to write file: {e}{RESET}")
         return False
 
 def prompt_apply(context_file: str, response: str) -> None:
     """If response has code blocks, offer to apply largest one to context_file."""
-    blocks = extract_code_blocks(response)
-    if not blocks:
+    block = largest_code_block(response)
+    if not block:
         return
-    # Pick the largest block
-    lang, code = max(blocks, key=lambda b: len(b[1]))
+    lang, code = block
     lines = code.count("\n") + 1
     print(f"\n{YELLOW}─── Code block detected ({lines} lines) ───{RESET}")
     print(f"{DIM}  Apply to {context_file}? [y/N] {RESET}", end="", flush=True)
@@ -271,7 +358,7 @@ def main():
         if response:
             history.append({"role": "assistant", "content": response})
             # Auto-offer to apply if context file present and response has code
-            if args.context_file and extract_code_blocks(response):
+            if args.context_file:
                 prompt_apply(args.context_file, response)
 
 if __name__ == "__main__":
@@ -1,29 +1,85 @@
 #!/usr/bin/env python3
 """Non-interactive IPC chat server for the Fresh Copilot Chat panel."""
+import asyncio
+import ctypes
+import http.client
 import json
+import logging
 import os
 import re
+import socket
+import struct
 import sys
 import time
+import urllib.parse
 import urllib.request
-import urllib.error
+from collections.abc import AsyncIterator, Iterator
+
+try:
+    import orjson  # optional: faster JSON on the streaming path
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+else:
+    _loads = json.loads
+
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
 
 APPS_JSON = os.path.expanduser("~/.config/github-copilot/apps.json")
 TOKEN_URL = "https://api.github.com/copilot_internal/v2/token"
 CHAT_URL  = "https://api.githubcopilot.com/chat/completions"
 
+log = logging.getLogger("copilot-chat-server")
+
+_CHAT_PARTS = urllib.parse.urlsplit(CHAT_URL)
+_MAX_IDLE_CONNECTIONS = 8
+_TOKEN_REFRESH_AHEAD = 120  # seconds before expiry
+_READ_SIZE = 16384  # one TLS record's worth per read
+_CMD_SHRINK_SETTLE = 0.05  # how long the command file may stay short before it counts as rewritten
+_IOV_MAX = 1024  # writev buffer limit on Linux and macOS
+MAX_VERBATIM_TURNS = 16  # older turns are sent as a rolling summary
+SUMMARY_BATCH_TURNS = 8  # fold this many at once, so the summary (a prompt prefix) rarely changes
+
+_CHAT_HEADERS = {
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+    "editor-version": "vscode/1.85.0",
+    "editor-plugin-version": "copilot-chat/0.12.0",
+    "Copilot-Integration-Id": "vscode-chat",
+}
+
 _session_token: str | None = None
 _session_expires: float = 0.0
+_auth_headers: dict[str, str] = {}  # _CHAT_HEADERS plus Authorization, rebuilt when the token rotates
+_oauth_cache: tuple[int, str] | None = None  # (apps.json mtime_ns, oauth token)
+# real path -> (mtime_ns, size, path as given, file context message, watched by inotify when read)
+_ctx_cache: dict[str, tuple[int, int, str, str, bool]] = {}
+
+# Keep-alive connections to the chat endpoint, only touched from the event loop
+_idle_conns: list[http.client.HTTPSConnection] = []
 
 def get_oauth_token() -> str:
+    global _oauth_cache
+    mtime = os.stat(APPS_JSON).st_mtime_ns
+    if _oauth_cache and _oauth_cache[0] == mtime:
+        return _oauth_cache[1]
     with open(APPS_JSON) as f:
         data = json.load(f)
-    return list(data.values())[0]["oauth_token"]
+    token = list(data.values())[0]["oauth_token"]
+    _oauth_cache = (mtime, token)
+    return token
 
-def get_session_token() -> str:
-    global _session_token, _session_expires
+def cached_session_token() -> str | None:
     if _session_token and time.time() < _session_expires - 60:
         return _session_token
+    return None
+
+def refresh_session_token() -> str:
+    global _session_token, _session_expires, _auth_headers
     oauth = get_oauth_token()
     req = urllib.request.Request(TOKEN_URL, headers={
         "Authorization": f"Bearer {oauth}",
@@ -33,137 +89,501 @@ def get_session_token() -> str:
     })
     with urllib.request.urlopen(req) as resp:
         data = json.loads(resp.read())
-        _session_token = data["token"]
+        token = data["token"]
+        # Runs in a worker thread while chats read these from the loop: the
+        # headers go first, since a set _session_token means they are ready
+        _auth_headers = {**_CHAT_HEADERS, "Authorization": f"Bearer {token}"}
         _session_expires = data.get("expires_at", time.time() + 1800)
-        return _session_token
+        _session_token = token
+        return token
+
+def get_session_token() -> str:
+    return cached_session_token() or refresh_session_token()
 
-def build_system_message(context_file: str | None, cursor_line: int | None,
-                          selection: str | None) -> str:
-    parts = [
-        "You are GitHub Copilot, a helpful AI programming assistant integrated into a terminal editor.",
-        "Be concise and helpful. Format explanatory code with fenced markdown code blocks.",
-        "When asked to edit or fix code in the current file, output ONLY the changed lines using this exact format:\n"
-        "```edit\n"
-        "<<<\n"
-        "start_line: <1-based line number>\n"
-        "end_line: <1-based line number, inclusive>\n"
-        "---\n"
-        "<replacement lines here>\n"
-        ">>>\n"
-        "```\n"
-        "Use one <<<...>>> block per contiguous changed region. Do NOT output the whole file. "
-        "start_line/end_line refer to the CURRENT line numbers in the file. "
-        "end_line must include every existing line you are replacing or removing - if your "
-        "replacement ends with a closing bracket/delimiter that already exists just after end_line, "
-        "extend end_line to include it, otherwise it will be duplicated in the file. "
-        "To insert lines before line N: set start_line=N, end_line=N-1 (end < start means pure insert). "
-        "To delete lines: set start_line/end_line to the range and leave replacement empty. "
-        "If the user is NOT asking to edit the file, just reply normally with text or code blocks.",
-    ]
-    if context_file and os.path.isfile(context_file):
+async def _token_refresher() -> None:
+    """Refresh the session token ahead of expiry so chats never wait on it."""
+    while True:
+        await asyncio.sleep(max(1, _session_expires - time.time() - _TOKEN_REFRESH_AHEAD))
         try:
-            with open(context_file) as f:
-                file_content = f.read(48000)
-            lang = os.path.splitext(context_file)[1].lstrip(".") or "text"
-            parts.append(f"\nThe user is editing: `{context_file}`")
-            if cursor_line is not None:
-                parts.append(f"Their cursor is on line {cursor_line + 1}.")
-            if selection:
-                parts.append(f"\nSelected text:\n```{lang}\n{selection}\n```")
-            numbered = "\n".join(f"{i+1}: {l}" for i, l in enumerate(file_content.splitlines()))
-            parts.append(f"\nFull file contents (with line numbers):\n```\n{numbered}\n```")
+            await asyncio.to_thread(refresh_session_token)
         except Exception:
+            # not signed in yet or offline; stream_response still refreshes on demand
+            await asyncio.sleep(30)
+
+# Identical on every request, so it stays a cacheable prompt prefix
+SYSTEM_PROMPT = "\n".join([
+    "You are GitHub Copilot, a helpful AI programming assistant integrated into a terminal editor.",
+    "Be concise and helpful. Format explanatory code with fenced markdown code blocks.",
+    "When asked to edit or fix code in the current file, output ONLY the changed lines using this exact format:\n"
+    "```edit\n"
+    "<<<\n"
+    "start_line: <1-based line number>\n"
+    "end_line: <1-based line number, inclusive>\n"
+    "---\n"
+    "<replacement lines here>\n"
+    ">>>\n"
+    "```\n"
+    "Use one <<<...>>> block per contiguous changed region. Do NOT output the whole file. "
+    "start_line/end_line refer to the CURRENT line numbers in the file. "
+    "end_line must include every existing line you are replacing or removing - if your "
+    "replacement ends with a closing bracket/delimiter that already exists just after end_line, "
+    "extend end_line to include it, otherwise it will be duplicated in the file. "
+    "To insert lines before line N: set start_line=N, end_line=N-1 (end < start means pure insert). "
+    "To delete lines: set start_line/end_line to the range and leave replacement empty. "
+    "If the user is NOT asking to edit the file, just reply normally with text or code blocks.",
+])
+
+# inotify(7) constants
+IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+IN_DELETE_SELF, IN_MOVE_SELF, IN_Q_OVERFLOW, IN_IGNORED = 0x400, 0x800, 0x4000, 0x8000
+
+class DirWatcher:
+    """inotify watches on context file directories, used to invalidate _ctx_cache (Linux only)."""
+
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+            | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+    def __init__(self) -> None:
+        self.fd = -1
+        self.dirs: dict[int, str] = {}  # wd -> directory
+        self.wds: dict[str, int] = {}   # directory -> wd
+        if not sys.platform.startswith("linux"):
+            return
+        try:
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            self.fd = -1
+
+    def watch(self, path: str) -> bool:
+        """Watch path's directory. False means the caller has to stat the file instead."""
+        if self.fd < 0:
+            return False
+        d = os.path.dirname(path)
+        if d in self.wds:
+            return True
+        # watching the directory also catches editors that save via rename
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(d or "."), self.MASK)
+        if wd < 0:
+            return False
+        self.dirs[wd] = d
+        self.wds[d] = wd
+        return True
+
+    def drain(self) -> None:
+        """Apply queued events to _ctx_cache; one non-blocking read when nothing changed."""
+        if self.fd < 0:
+            return
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            off = 0
+            while off < len(data):
+                wd, mask, _cookie, n = struct.unpack_from("iIII", data, off)
+                name = data[off + 16:off + 16 + n].rstrip(b"\0")
+                off += 16 + n
+                if mask & IN_Q_OVERFLOW:
+                    _ctx_cache.clear()
+                    continue
+                d = self.dirs.get(wd)
+                if d is None:
+                    continue
+                if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                    # the directory itself went away; forget it and everything under it
+                    if mask & IN_MOVE_SELF:
+                        self.libc.inotify_rm_watch(self.fd, wd)
+                    del self.dirs[wd]
+                    self.wds.pop(d, None)
+                    for path in [p for p in _ctx_cache if os.path.dirname(p) == d]:
+                        del _ctx_cache[path]
+                elif name:
+                    _ctx_cache.pop(os.path.join(d, os.fsdecode(name)), None)
+
+_watcher = DirWatcher()
+
+def build_file_context_message(context_file: str | None) -> str | None:
+    """Return the file-contents system message, re-rendering only when the file changed on disk."""
+    if not context_file:
+        return None
+    # Symlinks and unnormalized paths would put the watch on the wrong
+    # directory and never match inotify's names, so work on the real path
+    real = os.path.realpath(context_file)
+    # watch before reading, so a change can't slip in between
+    watched = _watcher.watch(real)
+    _watcher.drain()
+    try:
+        cached = _ctx_cache.get(real)
+        if cached and cached[2] == context_file:
+            if cached[4]:
+                return cached[3]  # still cached, so inotify saw no change
+            st = os.stat(real)
+            if cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+                return cached[3]
+        else:
+            st = os.stat(real)
+        with open(real) as f:
+            file_content = f.read(48000)
+    except Exception:
+        return None
+    numbered = "\n".join(f"{i}: {l}" for i, l in enumerate(file_content.splitlines(), 1))
+    message = (f"The user is editing: `{context_file}`\n"
+               f"\nFull file contents (with line numbers):\n```\n{numbered}\n```")
+    _ctx_cache[real] = (st.st_mtime_ns, st.st_size, context_file, message, watched)
+    return message
+
+def build_turn_context_message(context_file: str | None, cursor_line: int | None,
+                               selection: str | None) -> str | None:
+    """Cursor and selection change every turn, so they go after the history."""
+    if not context_file or not os.path.isfile(context_file):
+        return None
+    parts = []
+    if cursor_line is not None:
+        parts.append(f"Their cursor is on line {cursor_line + 1}.")
+    if selection:
+        lang = os.path.splitext(context_file)[1].lstrip(".") or "text"
+        parts.append(f"Selected text:\n```{lang}\n{selection}\n```")
+    return "\n".join(parts) or None
+
+_EDIT_OPEN_RE = re.compile(r"```edit\s*\n")
+_HUNK_RE      = re.compile(r"<<<\s*\n(.*?)>>>", re.DOTALL)
+# "12: " prefixes; [^\S\n] is \s without newlines, since lines are rejoined first
+_LINENO_RE    = re.compile(r"^\d+:[^\S\n]?", re.MULTILINE)
+
+
+def _parse_hunk(hunk: str) -> dict | None:
+    """Parse the body of one <<< ... >>> hunk; None if it has no valid line range."""
+    lines = hunk.splitlines()
+    try:
+        start_line = int(next(l.split(":")[1].strip() for l in lines if l.startswith("start_line:")))
+        end_line   = int(next(l.split(":")[1].strip() for l in lines if l.startswith("end_line:")))
+    except (StopIteration, ValueError):
+        return None
+    sep = next((i for i, l in enumerate(lines) if l.strip() == "---"), None)
+    replacement = "" if sep is None else _LINENO_RE.sub("", "\n".join(lines[sep + 1:]))
+    return {"start_line": start_line, "end_line": end_line, "replacement": replacement}
+
+class EditStreamer:
+    """Extracts ```edit hunks from a streamed reply as soon as each one closes."""
+
+    def __init__(self) -> None:
+        self.buf = ""  # unconsumed tail of the reply
+        self.in_block = False
+        self.edits: list[dict] = []
+
+    def feed(self, delta: str) -> list[dict]:
+        """Add delta to the reply and return the edits it completed."""
+        self.buf += delta
+        # a hunk or block only ever closes on ">>>" or "```"
+        if ">" not in delta and "`" not in delta:
+            return []
+        buf = self.buf
+        pos = 0
+        start = len(self.edits)
+        while True:
+            if not self.in_block:
+                m = _EDIT_OPEN_RE.search(buf, pos)
+                if m is None:
+                    # keep the last fence, it may still grow into an opener
+                    i = buf.rfind("```", pos)
+                    pos = i if i >= 0 else max(pos, len(buf) - 2)
+                    break
+                self.in_block = True
+                pos = m.end()
+            close = buf.find("```", pos)
+            m = _HUNK_RE.search(buf, pos, close if close >= 0 else len(buf))
+            if m:
+                edit = _parse_hunk(m.group(1))
+                if edit is not None:
+                    self.edits.append(edit)
+                pos = m.end()
+                continue
+            if close < 0:
+                break
+            self.in_block = False
+            pos = close + 3
+        # drop the consumed prefix once per feed rather than once per hunk
+        self.buf = buf[pos:]
+        return self.edits[start:]
+
+def _new_conn() -> http.client.HTTPSConnection:
+    return http.client.HTTPSConnection(_CHAT_PARTS.netloc, timeout=60)
+
+def _acquire_conn() -> http.client.HTTPSConnection:
+    return _idle_conns.pop() if _idle_conns else _new_conn()
+
+def _release_conn(conn: http.client.HTTPSConnection, resp: http.client.HTTPResponse | None) -> None:
+    # Only a fully read response leaves the connection reusable
+    if resp is not None and resp.isclosed() and not resp.will_close \
+            and len(_idle_conns) < _MAX_IDLE_CONNECTIONS:
+        _idle_conns.append(conn)
+        return
+    # A cancelled stream can still have a worker thread blocked in
+    # resp.read1(); closing waits on that read, so shut the socket down to
+    # wake it and close off the event loop
+    if conn.sock is not None:
+        try:
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
             pass
-    return "\n".join(parts)
+    asyncio.get_running_loop().run_in_executor(None, _close_conn, conn, resp)
+
+def _close_conn(conn: http.client.HTTPSConnection, resp: http.client.HTTPResponse | None) -> None:
+    conn.close()
+    if resp is not None:
+        resp.close()  # a will_close response owns the socket, not conn
+
+async def _prewarm_conn() -> None:
+    """Connect ahead of the first chat so it does not pay the TCP/TLS handshake."""
+    conn = _new_conn()
+    try:
+        await asyncio.to_thread(conn.connect)
+    except OSError:
+        conn.close()
+        return
+    if len(_idle_conns) < _MAX_IDLE_CONNECTIONS:
+        _idle_conns.append(conn)
+    else:
+        conn.close()
+
+def _open_stream(conn: http.client.HTTPSConnection, body: bytes,
+                 headers: dict) -> tuple[http.client.HTTPSConnection, http.client.HTTPResponse]:
+    """POST body on conn, retrying once on a fresh connection if a reused one went stale."""
+    reused = conn.sock is not None
+    try:
+        conn.request("POST", _CHAT_PARTS.path, body=body, headers=headers)
+        return conn, conn.getresponse()
+    except (http.client.RemoteDisconnected, ConnectionError):
+        conn.close()
+        if not reused:
+            raise
+    conn = _new_conn()
+    conn.request("POST", _CHAT_PARTS.path, body=body, headers=headers)
+    return conn, conn.getresponse()
+
+_EVENT_END_RE = re.compile(rb"\r?\n\r?\n")
 
-def extract_edits(text: str) -> list[dict]:
-    edits = []
-    for block in re.findall(r"```edit\s*\n(.*?)(?:```|$)", text, re.DOTALL):
-        for hunk in re.findall(r"<<<\s*\n(.*?)>>>", block, re.DOTALL):
-            lines = hunk.splitlines()
+class SSEParser:
+    """Incremental server-sent events parser: feed raw bytes, get each event's data field as bytes."""
+
+    def __init__(self) -> None:
+        self.buf = bytearray()
+
+    def feed(self, chunk: bytes) -> Iterator[bytes]:
+        self.buf += chunk
+        pos = 0
+        while (m := _EVENT_END_RE.search(self.buf, pos)) is not None:
+            event = bytes(self.buf[pos:m.start()])
+            pos = m.end()
+            if event.startswith(b"data:") and b"\n" not in event and b"\r" not in event:
+                # the usual one-line "data: {...}" event
+                yield event[5:].removeprefix(b" ")
+                continue
+            data_lines = [l[5:].removeprefix(b" ") for l in event.splitlines() if l.startswith(b"data:")]
+            if data_lines:
+                yield b"\n".join(data_lines)
+        del self.buf[:pos]
+
+def _writev_all(fd: int, bufs: list[bytes]) -> None:
+    if not hasattr(os, "writev"):
+        rest = b"".join(bufs)
+    else:
+        n = os.writev(fd, bufs)
+        if n == sum(map(len, bufs)):
+            return
+        # short write (e.g. disk nearly full): finish the rest with plain writes
+        rest = b"".join(bufs)[n:]
+    while rest:
+        rest = rest[os.write(fd, rest):]
+
+class ResponseWriter:
+    """Queues outgoing JSON lines and appends each batch to the response file with one writev."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.queue: asyncio.Queue[bytes] = asyncio.Queue()
+        self.fd = -1
+
+    def send(self, msg: dict) -> None:
+        self.queue.put_nowait(_dumps(msg) + b"\n")
+
+    def _fd(self) -> int:
+        # Truncating keeps the inode and O_APPEND follows the new end; if the
+        # file was replaced instead, our inode is orphaned and must be reopened
+        if self.fd >= 0 and os.fstat(self.fd).st_nlink > 0:
+            return self.fd
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT
+                          | getattr(os, "O_CLOEXEC", 0) | getattr(os, "O_BINARY", 0), 0o644)
+        return self.fd
+
+    async def run(self) -> None:
+        while True:
+            pending = [await self.queue.get()]
+            while not self.queue.empty() and len(pending) < _IOV_MAX:
+                pending.append(self.queue.get_nowait())
             try:
-                start_line = int(next(l.split(":")[1].strip() for l in lines if l.startswith("start_line:")))
-                end_line   = int(next(l.split(":")[1].strip() for l in lines if l.startswith("end_line:")))
-                sep = next((i for i, l in enumerate(lines) if l.strip() == "---"), None)
-                if sep is not None:
-                    replacement_lines = lines[sep+1:]
-                    stripped = [re.sub(r"^\d+:\s?", "", rl) for rl in replacement_lines]
-                    replacement = "\n".join(stripped)
-                else:
-                    replacement = ""
-                edits.append({"start_line": start_line, "end_line": end_line, "replacement": replacement})
-            except (StopIteration, ValueError):
+                _writev_all(self._fd(), pending)
+            except OSError:
                 pass
-    return edits
+            except Exception:
+                # anything else is a bug; keep the writer alive for the next batch
+                log.exception("Failed to write %d chat response line(s)", len(pending))
+
+async def _sse_payloads(resp: http.client.HTTPResponse) -> AsyncIterator[bytes]:
+    parser = SSEParser()
+    while chunk := await asyncio.to_thread(resp.read1, _READ_SIZE):
+        for payload in parser.feed(chunk):
+            if payload == b"[DONE]":
+                # drain the terminating chunk so the connection can be reused
+                await asyncio.to_thread(resp.read)
+                return
+            yield payload
 
-def stream_response(messages: list, model: str, req_id: str, resp_file: str, context_file: str | None = None) -> str:
+async def complete(messages: list, model: str) -> str:
+    """Non-streaming chat completion, for requests the user doesn't see."""
+    if cached_session_token() is None:
+        await asyncio.to_thread(refresh_session_token)
+    body = _dumps({
+        "model": model,
+        "messages": messages,
+        "stream": False,
+        "temperature": 0.1,
+        "top_p": 1,
+    })
+    conn = _acquire_conn()
+    resp = None
+    try:
+        conn, resp = await asyncio.to_thread(_open_stream, conn, body, _auth_headers)
+        data = await asyncio.to_thread(resp.read)
+        if resp.status != 200:
+            raise RuntimeError(f"HTTP {resp.status}: {data.decode(errors='replace')}")
+        return _loads(data)["choices"][0]["message"]["content"]
+    finally:
+        _release_conn(conn, resp)
+
+async def summarize_history(summary: str, messages: list[dict], model: str) -> str:
+    """Fold messages into the rolling summary of the conversation so far."""
+    transcript = "\n\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    if summary:
+        transcript = f"Summary so far:\n{summary}\n\nLater messages:\n{transcript}"
+    return await complete([
+        {"role": "system", "content":
+            "Summarize this earlier part of a conversation between a user and a programming "
+            "assistant in a few sentences. Keep decisions, names and file details that later "
+            "turns may rely on. Reply with the summary only."},
+        {"role": "user", "content": transcript},
+    ], model)
+
+async def stream_response(messages: list, model: str, req_id: str, out: ResponseWriter, context_file: str | None = None) -> str:
     try:
-        token = get_session_token()
+        if cached_session_token() is None:
+            await asyncio.to_thread(refresh_session_token)
     except Exception as e:
-        with open(resp_file, "a") as f:
-            f.write(json.dumps({"id": req_id, "type": "error", "content": f"Auth error: {e}"}) + "\n")
+        out.send({"id": req_id, "type": "error", "content": f"Auth error: {e}"})
         return ""
 
-    body = json.dumps({
+    body = _dumps({
         "model": model,
         "messages": messages,
         "stream": True,
         "temperature": 0.1,
         "top_p": 1,
-    }).encode()
-    req = urllib.request.Request(CHAT_URL, data=body, method="POST", headers={
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        "editor-version": "vscode/1.85.0",
-        "editor-plugin-version": "copilot-chat/0.12.0",
-        "Copilot-Integration-Id": "vscode-chat",
     })
     full_content = ""
+    streamer = EditStreamer()
+    conn = _acquire_conn()
+    resp = None
     try:
-        with urllib.request.urlopen(req, timeout=60) as resp:
-            for raw_line in resp:
-                line = raw_line.decode("utf-8").strip()
-                if not line.startswith("data: "):
+        conn, resp = await asyncio.to_thread(_open_stream, conn, body, _auth_headers)
+        if resp.status != 200:
+            err = (await asyncio.to_thread(resp.read)).decode()
+            out.send({"id": req_id, "type": "error", "content": f"HTTP {resp.status}: {err}"})
+            return ""
+        async for payload in _sse_payloads(resp):
+            try:
+                chunk = _loads(payload)
+                choices = chunk.get("choices", [])
+                if not choices:
                     continue
-                payload = line[6:]
-                if payload == "[DONE]":
-                    break
-                try:
-                    chunk = json.loads(payload)
-                    choices = chunk.get("choices", [])
-                    if not choices:
-                        continue
-                    delta = choices[0]["delta"].get("content", "")
-                    if delta:
-                        full_content += delta
-                        with open(resp_file, "a") as f:
-                            f.write(json.dumps({"id": req_id, "type": "chunk", "content": delta}) + "\n")
-                except (KeyError, json.JSONDecodeError):
-                    pass
-    except urllib.error.HTTPError as e:
-        err = e.read().decode()
-        with open(resp_file, "a") as f:
-            f.write(json.dumps({"id": req_id, "type": "error", "content": f"HTTP {e.code}: {err}"}) + "\n")
-        return ""
+                delta = choices[0]["delta"].get("content", "")
+                if delta:
+                    full_content += delta
+                    out.send({"id": req_id, "type": "chunk", "content": delta})
+                    for edit in streamer.feed(delta):
+                        out.send({"id": req_id, "type": "edit", "edit": edit})
+            except (KeyError, json.JSONDecodeError):
+                pass
     except Exception as e:
-        with open(resp_file, "a") as f:
-            f.write(json.dumps({"id": req_id, "type": "error", "content": str(e)}) + "\n")
+        out.send({"id": req_id, "type": "error", "content": str(e)})
         return ""
+    finally:
+        _release_conn(conn, resp)
 
-    edits = extract_edits(full_content)
-    with open(resp_file, "a") as f:
-        f.write(json.dumps({
-            "id": req_id, "type": "done",
-            "has_edits": len(edits) > 0,
-            "edits": edits,
-            "context_file": context_file,
-        }) + "\n")
+    edits = streamer.edits
+    out.send({
+        "id": req_id, "type": "done",
+        "has_edits": len(edits) > 0,
+        "edits": edits,
+        "context_file": context_file,
+    })
     return full_content
 
-def run_server(ipc_dir: str) -> None:
+class CommandReader:
+    """Reads the newline-delimited JSON commands appended to the command file.
+
+    JSON escapes newlines inside strings, so a newline always ends a frame.
+    Malformed lines are skipped.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.offset = 0
+        self.shrunk_at: float | None = None
+
+    def read(self) -> list[dict]:
+        """Return the commands appended since the last read."""
+        try:
+            size = os.stat(self.path).st_size
+        except FileNotFoundError:
+            self.offset = 0
+            return []
+        if size < self.offset:
+            # The plugin rewrites the whole file to append, so it is briefly
+            # short mid-write; only a file that stays short was started afresh
+            now = time.monotonic()
+            if self.shrunk_at is None:
+                self.shrunk_at = now
+            if now - self.shrunk_at < _CMD_SHRINK_SETTLE:
+                return []
+            self.offset = 0
+        self.shrunk_at = None
+        if size == self.offset:
+            return []
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        # leave a half-written trailing line for the next poll
+        end = data.rfind(b"\n") + 1
+        self.offset += end
+        cmds = []
+        for line in data[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                cmds.append(_loads(line))
+            except json.JSONDecodeError:
+                pass
+        return cmds
+
+async def run_server(ipc_dir: str) -> None:
     cmd_file  = os.path.join(ipc_dir, "chat_cmd")
     resp_file = os.path.join(ipc_dir, "chat_resp")
+    out = ResponseWriter(resp_file)
 
     portfile = os.path.join(ipc_dir, "chat_ready")
     with open(portfile, "w") as f:
@@ -171,69 +591,108 @@ def run_server(ipc_dir: str) -> None:
 
     model = "gpt-4o"
     # conversation: list of {role, content, context_file, cursor_line, selection}
-    # We rebuild system message fresh each request to pick up file changes
+    # The file context message is rebuilt whenever the file changes on disk
     history: list[dict] = []
-    last_cmd_size = 0
+    commands = CommandReader(cmd_file)
+    # in-flight chats, so several message IDs can stream at once
+    tasks: set[asyncio.Task] = set()
+    # hold references so the background tasks are not garbage collected
+    refresher = asyncio.create_task(_token_refresher())
+    writer = asyncio.create_task(out.run())
+    prewarm = asyncio.create_task(_prewarm_conn())
+
+    # turns older than the verbatim window are folded into this summary
+    summary = ""
+    summarizer: asyncio.Task | None = None
+
+    async def summarize_dropped(model: str) -> None:
+        nonlocal summary
+        dropped = history[:-MAX_VERBATIM_TURNS * 2]
+        try:
+            summary = await summarize_history(summary, dropped, model)
+        except Exception:
+            return  # keep the old summary, retried after the next turn
+        # only now leave the prompt; turns added meanwhile are past this range
+        del history[:len(dropped)]
+
+    async def handle_message(messages: list, message: str, model: str, req_id: str,
+                             context_file: str | None) -> None:
+        nonlocal summarizer
+        assistant_text = await stream_response(messages, model, req_id, out, context_file)
+        history.append({"role": "user", "content": message})
+        if assistant_text:
+            history.append({"role": "assistant", "content": assistant_text})
+        if len(history) > (MAX_VERBATIM_TURNS + SUMMARY_BATCH_TURNS) * 2 \
+                and (summarizer is None or summarizer.done()):
+            summarizer = asyncio.create_task(summarize_dropped(model))
 
     while True:
         try:
-            if os.path.exists(cmd_file):
-                size = os.path.getsize(cmd_file)
-                if size > last_cmd_size:
-                    with open(cmd_file, "r") as f:
-                        f.seek(last_cmd_size)
-                        new_data = f.read()
-                    last_cmd_size = size
-
-                    for line in new_data.splitlines():
-                        line = line.strip()
-                        if not line:
-                            continue
-                        try:
-                            cmd = json.loads(line)
-                        except json.JSONDecodeError:
-                            continue
-
-                        cmd_type = cmd.get("type", "message")
-
-                        if cmd_type == "clear":
-                            history = []
-                            last_cmd_size = 0
-                            with open(cmd_file, "w") as f:
-                                pass
-                            with open(resp_file, "w") as f:
-                                pass
-                            continue
-
-                        if cmd_type == "model":
-                            model = cmd.get("model", model)
-                            continue
-
-                        if cmd_type == "message":
-                            req_id = cmd.get("id", "")
-                            message = cmd.get("message", "")
-                            context_file = cmd.get("context_file")
-                            cursor_line = cmd.get("cursor_line")
-                            selection = cmd.get("selection")
-
-                            system_msg = build_system_message(context_file, cursor_line, selection)
-                            messages = [{"role": "system", "content": system_msg}]
-                            for h in history:
-                                messages.append({"role": h["role"], "content": h["content"]})
-                            messages.append({"role": "user", "content": message})
-
-                            assistant_text = stream_response(messages, model, req_id, resp_file, context_file)
-
-                            history.append({"role": "user", "content": message})
-                            if assistant_text:
-                                history.append({"role": "assistant", "content": assistant_text})
+            for cmd in commands.read():
+                cmd_type = cmd.get("type", "message")
+
+                if cmd_type == "clear":
+                    for task in tasks:
+                        task.cancel()
+                    if summarizer is not None:
+                        summarizer.cancel()
+                    history = []
+                    summary = ""
+                    commands.offset = 0
+                    with open(cmd_file, "w") as f:
+                        pass
+                    with open(resp_file, "w") as f:
+                        pass
+                    continue
+
+                if cmd_type == "model":
+                    model = cmd.get("model", model)
+                    continue
+
+                if cmd_type == "message":
+                    req_id = cmd.get("id", "")
+                    message = cmd.get("message", "")
+                    context_file = cmd.get("context_file")
+                    cursor_line = cmd.get("cursor_line")
+                    selection = cmd.get("selection")
+
+                    # Stable prefix first (instructions, file contents, history) so the
+                    # provider's prompt cache can reuse it; per-turn details go last
+                    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+                    file_msg = build_file_context_message(context_file)
+                    if file_msg:
+                        messages.append({"role": "system", "content": file_msg})
+                    if summary:
+                        messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+                    # everything not yet folded into the summary, which may run
+                    # SUMMARY_BATCH_TURNS past the window while a fold is pending
+                    for h in history:
+                        messages.append({"role": h["role"], "content": h["content"]})
+                    turn_msg = build_turn_context_message(context_file, cursor_line, selection)
+                    if turn_msg:
+                        messages.append({"role": "system", "content": turn_msg})
+                    messages.append({"role": "user", "content": message})
+
+                    task = asyncio.create_task(handle_message(messages, message, model, req_id, context_file))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
 
         except Exception:
             pass
 
-        time.sleep(0.05)
+        await asyncio.sleep(0.05)
 
 if __name__ == "__main__":
     ipc_dir = sys.argv[1] if len(sys.argv) > 1 else "/tmp/copilot_chat_ipc"
     os.makedirs(ipc_dir, exist_ok=True)
-    run_server(ipc_dir)
+    try:
+        import uvloop  # optional: libuv-based event loop, if installed
+    except ImportError:
+        uvloop = None
+    if uvloop is not None and getattr(uvloop, "run", None) is not None:
+        uvloop.run(run_server(ipc_dir))
+    else:
+        if uvloop is not None:
+            # uvloop older than 0.18 has no run(); install it as the loop policy
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        asyncio.run(run_server(ipc_dir))
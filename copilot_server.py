@@ -3,32 +3,68 @@
 Usage: python3 copilot_server.py <server_binary> <workspace_folder> <port_file>
 """
 
+import collections
+import contextlib
+import ctypes
+import functools
+import itertools
 import json
 import logging
 import os
+import pathlib
+import queue
+import re
+import selectors
+import shutil
+import signal
+import struct
 import subprocess
 import sys
 import threading
 import time
 
+try:
+    import orjson  # optional: faster JSON on the LSP and IPC paths
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+else:
+    _loads = json.loads
+
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
 log = logging.getLogger("copilot-server")
 
 lsp_process = None
-lsp_lock = threading.Lock()
+stdin_queue = queue.Queue()  # lists of (buffer, length) frames for the stdin writer
 
 pending_requests = {}  # lsp_id -> (plugin_req_id, method)
 request_counter = 0
 request_counter_lock = threading.Lock()
 
 ipc_dir = ""
+resp_fp = None
+resp_lock = threading.Lock()
+resp_queue = queue.Queue()  # encoded lines for resp_writer; None stops it
+IOV_MAX = 1024  # writev buffer limit on Linux and macOS
+
+send_buf_pool = queue.LifoQueue(maxsize=8)  # reusable frame buffers for lsp_send
 shutdown_event = threading.Event()
 
 
-def _get_log_path():
+def _get_fresh_cache_dir():
     cache = os.environ.get("XDG_CACHE_HOME")
     if not cache:
         cache = os.path.join(os.path.expanduser("~"), ".cache")
-    log_dir = os.path.join(cache, "fresh")
+    return os.path.join(cache, "fresh")
+
+
+def _get_log_path():
+    log_dir = _get_fresh_cache_dir()
     os.makedirs(log_dir, exist_ok=True)
     return os.path.join(log_dir, "copilot-server.log")
 
@@ -46,14 +82,61 @@ def _init_logging():
     log.info("Log: %s", log_path)
 
 
+def _resp_file():
+    global resp_fp
+    # The plugin truncates resp in place, which O_APPEND follows; if the file
+    # was replaced instead, our inode is orphaned and must be reopened
+    if resp_fp is not None and os.fstat(resp_fp.fileno()).st_nlink > 0:
+        return resp_fp
+    if resp_fp is not None:
+        resp_fp.close()
+        resp_fp = None
+    resp_fp = open(os.path.join(ipc_dir, "resp"), "ab", buffering=0)
+    return resp_fp
+
+
+def _write_all(fd: int, bufs: list):
+    if not hasattr(os, "writev"):
+        data = b"".join(bufs)
+    else:
+        n = os.writev(fd, bufs)
+        if n == sum(map(len, bufs)):
+            return
+        # short write (e.g. disk nearly full): finish the rest with plain writes
+        data = b"".join(bufs)[n:]
+    while data:
+        data = data[os.write(fd, data):]
+
+
 def write_resp(data):
-    path = os.path.join(ipc_dir, "resp")
-    line = json.dumps(data) + "\n"
-    try:
-        with open(path, "a") as f:
-            f.write(line)
-    except OSError as e:
-        log.error("Failed to write response: %s", e)
+    resp_queue.put(_dumps(data) + b"\n")
+
+
+def write_resp_encoded(line: bytes):
+    """Queue a message that is already encoded, newline included."""
+    resp_queue.put(line)
+
+
+def resp_writer():
+    """Drains resp_queue, appending everything queued since the last wakeup in one writev."""
+    stop = False
+    while not stop:
+        batch = [resp_queue.get()]
+        while len(batch) < IOV_MAX:
+            try:
+                batch.append(resp_queue.get_nowait())
+            except queue.Empty:
+                break
+        if None in batch:
+            stop = True
+            batch = [line for line in batch if line is not None]
+        if not batch:
+            continue
+        try:
+            with resp_lock:
+                _write_all(_resp_file().fileno(), batch)
+        except OSError as e:
+            log.error("Failed to write response: %s", e)
 
 
 def next_lsp_id():
@@ -64,26 +147,142 @@ def next_lsp_id():
 
 
 def lsp_send(message: dict):
-    global lsp_process
-    with lsp_lock:
-        proc = lsp_process
+    lsp_send_body(_dumps(message), message.get("method") or f"response/{message.get('id')}")
+
+
+def lsp_send_body(body: bytes, what: str):
+    """Frame an already-encoded JSON-RPC message and queue it for the server."""
+    proc = lsp_process  # set once in main before any sender runs
     if proc is None or proc.poll() is not None:
-        log.warning("LSP process not running, cannot send: %s", message.get("method", "?"))
+        log.warning("LSP process not running, cannot send: %s", what)
+        return
+    try:
+        buf = send_buf_pool.get_nowait()
+    except queue.Empty:
+        buf = bytearray(4096)
+    header = b"Content-Length: %d\r\n\r\n" % len(body)
+    n = len(header) + len(body)
+    if len(buf) < n:
+        buf.extend(bytes(n - len(buf)))
+    # overwrite in place: clearing a bytearray gives its capacity back
+    buf[:len(header)] = header
+    buf[len(header):n] = body
+    frames = getattr(_send_batch, "frames", None)
+    if frames is not None:
+        frames.append((buf, n))
+    else:
+        stdin_queue.put([(buf, n)])
+    log.debug("LSP >> %s", what)
+
+
+_send_batch = threading.local()
+
+
+@contextlib.contextmanager
+def lsp_batch():
+    """Queue this thread's lsp_send frames as one stdin write batch when the block ends."""
+    if getattr(_send_batch, "frames", None) is not None:
+        yield  # nested: the outermost block queues everything
         return
+    _send_batch.frames = frames = []
     try:
-        body = json.dumps(message).encode("utf-8")
-        header = f"Content-Length: {len(body)}\r\n\r\n".encode()
-        proc.stdin.write(header + body)
-        proc.stdin.flush()
-        log.debug("LSP >> %s", message.get("method") or f"response/{message.get('id')}")
-    except (BrokenPipeError, OSError) as e:
-        log.error("LSP send error: %s", e)
+        yield
+    finally:
+        _send_batch.frames = None
+        if frames:
+            stdin_queue.put(frames)
+
+
+def stdin_writer(proc):
+    """Writes queued frames to the server's stdin, flushing once the queue runs dry.
+
+    Only used where io_loop cannot wait on pipes (Windows). Writes block while
+    the server's stdin pipe is full, and the server may be blocked writing to
+    us at that moment; doing them here keeps the stdout reader free.
+    """
+    while True:
+        frames = stdin_queue.get()
+        if frames is None:
+            return
+        try:
+            for buf, n in frames:
+                with memoryview(buf) as view:
+                    proc.stdin.write(view[:n])  # copied into stdin's buffer unless it bypasses it
+            if stdin_queue.empty():
+                proc.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError) as e:
+            log.error("LSP send error: %s", e)
+        finally:
+            for buf, _ in frames:
+                try:
+                    send_buf_pool.put_nowait(buf)
+                except queue.Full:
+                    break
 
 
-def lsp_request(method: str, params: dict, plugin_req_id=None):
+class StdinPipe:
+    """Writes queued frames to the server's stdin without ever blocking.
+
+    The server may be blocked writing its stdout while its stdin pipe is
+    full, so io_loop must keep reading; whatever the pipe does not take now
+    stays queued until the selector reports it writable.
+    """
+
+    def __init__(self, fd: int):
+        self.fd = fd
+        os.set_blocking(fd, False)
+        self.frames = collections.deque()  # (buffer, view of its unsent bytes)
+
+    def take(self):
+        """Move everything in stdin_queue behind the frames already waiting."""
+        while True:
+            try:
+                frames = stdin_queue.get_nowait()
+            except queue.Empty:
+                return
+            for buf, n in frames:
+                self.frames.append((buf, memoryview(buf)[:n]))
+
+    def _pop(self):
+        buf, view = self.frames.popleft()
+        view.release()  # a bytearray cannot grow while a view is held
+        try:
+            send_buf_pool.put_nowait(buf)
+        except queue.Full:
+            pass
+
+    def flush(self) -> bool:
+        """Write as much as the pipe takes; True while frames are left over."""
+        while self.frames:
+            views = [view for _, view in itertools.islice(self.frames, IOV_MAX)]
+            try:
+                n = os.writev(self.fd, views)
+            except BlockingIOError:
+                return True
+            except OSError as e:
+                log.error("LSP send error: %s", e)
+                while self.frames:
+                    self._pop()
+                return False
+            while n and n >= len(self.frames[0][1]):
+                n -= len(self.frames[0][1])
+                self._pop()
+            if n:
+                buf, view = self.frames[0]
+                self.frames[0] = (buf, view[n:])
+                view.release()
+        return False
+
+
+def _register_request(method: str, plugin_req_id) -> int:
     lsp_id = next_lsp_id()
     if plugin_req_id is not None:
         pending_requests[lsp_id] = (plugin_req_id, method)
+    return lsp_id
+
+
+def lsp_request(method: str, params: dict, plugin_req_id=None):
+    lsp_id = _register_request(method, plugin_req_id)
     lsp_send({"jsonrpc": "2.0", "id": lsp_id, "method": method, "params": params})
     return lsp_id
 
@@ -92,60 +291,166 @@ def lsp_notify(method: str, params: dict):
     lsp_send({"jsonrpc": "2.0", "method": method, "params": params})
 
 
-def read_lsp_messages():
-    global lsp_process
-    with lsp_lock:
-        proc = lsp_process
-    if proc is None:
-        return
+CL_PREFIX = b"Content-Length:"
+LSP_READ_SIZE = 65536
 
-    buf = b""
-    while not shutdown_event.is_set():
+# Notifications handle_lsp_message drops anyway; spotted in the raw body so
+# they are never parsed. A string value inside another message would have
+# its quotes escaped, so it cannot match
+_IGNORED_NOTIFICATION_RE = re.compile(rb'"method"\s*:\s*"\$/(?:progress|logTrace)"')
+
+
+def _parse_framed(buf, start: int = 0, end=None):
+    """Split Content-Length framed messages out of buf[start:end].
+
+    Returns (bodies, offset of the first unconsumed byte).
+    """
+    if end is None:
+        end = len(buf)
+    bodies = []
+    while True:
+        header_end = buf.find(b"\r\n\r\n", start, end)
+        if header_end == -1:
+            break
+        content_length = None
+        for line in buf[start:header_end].split(b"\r\n"):
+            # header names are case-insensitive, but servers send this spelling
+            if line.startswith(CL_PREFIX) or line[:15].lower() == b"content-length:":
+                content_length = int(line[15:])  # int() skips the surrounding whitespace itself
+                break
+        body_start = header_end + 4
+        if content_length is None:
+            log.warning("No Content-Length in LSP header, discarding")
+            start = body_start
+            continue
+        if end < body_start + content_length:
+            break  # need more data
+        bodies.append(buf[body_start:body_start + content_length])
+        start = body_start + content_length
+    return bodies, start
+
+
+class LspReader:
+    """Parses Content-Length frames from the server's stdout in place.
+
+    Frames are parsed between r and w in one bytearray. Every read gets at
+    least LSP_READ_SIZE of room, so a large body arrives in a few syscalls;
+    the unparsed tail is only moved to the front when that room runs out.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream  # unbuffered: one readinto is one read(2)
+        self.buf = bytearray(4 * LSP_READ_SIZE)
+        self.view = memoryview(self.buf)
+        self.r = self.w = 0
+
+    def read_once(self) -> bool:
+        """Read what is available and dispatch complete frames; False once stdout is gone."""
+        buf = self.buf
         try:
-            chunk = proc.stdout.read1(4096)  # non-blocking read
-            if not chunk:
+            if self.r == self.w:
+                self.r = self.w = 0
+            if len(buf) - self.w < LSP_READ_SIZE and self.r:
+                buf[:self.w - self.r] = self.view[self.r:self.w]
+                self.w -= self.r
+                self.r = 0
+            if len(buf) - self.w < LSP_READ_SIZE:
+                self.view.release()
+                buf.extend(bytes(len(buf)))
+                self.view = memoryview(buf)
+            n = self.stream.readinto(self.view[self.w:])
+            if not n:
                 log.info("LSP stdout closed")
-                break
-            buf += chunk
-            while True:
-                header_end = buf.find(b"\r\n\r\n")
-                if header_end == -1:
-                    break
-                header_bytes = buf[:header_end]
-                content_length = None
-                for line in header_bytes.split(b"\r\n"):
-                    if line.lower().startswith(b"content-length:"):
-                        content_length = int(line.split(b":", 1)[1].strip())
-                        break
-                if content_length is None:
-                    log.warning("No Content-Length in LSP header, discarding")
-                    buf = buf[header_end + 4:]
-                    break
-                start = header_end + 4
-                if len(buf) < start + content_length:
-                    break  # need more data
-                body = buf[start:start + content_length]
-                buf = buf[start + content_length:]
+                return False
+            self.w += n
+            bodies, self.r = _parse_framed(buf, self.r, self.w)
+        except (OSError, ValueError) as e:
+            log.error("LSP read error: %s", e)
+            return False
+        with lsp_batch():  # replies to server requests go out together
+            for body in bodies:
+                if _IGNORED_NOTIFICATION_RE.search(body):
+                    continue
                 try:
-                    msg = json.loads(body.decode("utf-8"))
+                    msg = _loads(body)
                     handle_lsp_message(msg)
                 except (json.JSONDecodeError, UnicodeDecodeError) as e:
                     log.error("LSP parse error: %s", e)
-        except (OSError, ValueError) as e:
-            log.error("LSP read error: %s", e)
-            break
+                except Exception:
+                    log.exception("Failed to handle LSP message: %r", bytes(body[:80]))
+        return True
 
-    log.info("LSP reader thread exiting")
+    def run(self):
+        while not shutdown_event.is_set() and self.read_once():
+            pass
+        _lsp_stdout_closed()
+
+
+def _lsp_stdout_closed():
+    log.info("LSP reader exiting")
     write_resp({"type": "serverStopped"})
 
 
+def _lsp_ignore(msg_id, params):
+    pass  # verbose noise
+
+
+def _lsp_log_message(msg_id, params):
+    log.debug("LSP logMessage [%s]: %s", params.get("type"), params.get("message", ""))
+
+
+def _lsp_show_message(msg_id, params):
+    write_resp({"type": "showMessage", "message": params.get("message", ""), "msgType": params.get("type", 3)})
+
+
+def _lsp_show_message_request(msg_id, params):
+    log.info("LSP showMessageRequest: %s", params.get("message", ""))
+    write_resp({"type": "showMessageRequest", "id": str(msg_id), "message": params.get("message", ""), "msgType": params.get("type", 3), "actions": params.get("actions", [])})
+    # Auto-respond null so the server isn't blocked
+    lsp_send({"jsonrpc": "2.0", "id": msg_id, "result": None})
+
+
+def _lsp_show_document(msg_id, params):
+    uri = params.get("uri", "")
+    write_resp({"type": "showDocument", "uri": uri})
+    lsp_send({"jsonrpc": "2.0", "id": msg_id, "result": {"success": True}})
+
+
+def _lsp_configuration(msg_id, params):
+    items = params.get("items", [])
+    lsp_send({"jsonrpc": "2.0", "id": msg_id, "result": [None] * len(items)})
+
+
+_STATUS_CHANGED_TEMPLATE = b'{"type":"statusChanged","message":%b,"kind":%b}\n'
+
+
+def _lsp_status(msg_id, params):
+    write_resp_encoded(_STATUS_CHANGED_TEMPLATE % (_dumps(params.get("message", "")), _dumps(params.get("kind", "Normal"))))
+
+
+# Notifications and server requests, by method
+_LSP_METHOD_HANDLERS = {
+    "$/logTrace": _lsp_ignore,
+    "$/progress": _lsp_ignore,
+    "window/logMessage": _lsp_log_message,
+    "window/showMessage": _lsp_show_message,
+    "window/showMessageRequest": _lsp_show_message_request,
+    "window/showDocument": _lsp_show_document,
+    "workspace/configuration": _lsp_configuration,
+    "copilot/didChangeStatus": _lsp_status,
+    "didChangeStatus": _lsp_status,
+    "statusNotification": _lsp_status,
+}
+
+
 def handle_lsp_message(msg: dict):
     msg_id = msg.get("id")
     method = msg.get("method")
 
     if msg_id is not None and method is None:
-        if msg_id in pending_requests:
-            plugin_req_id, req_method = pending_requests.pop(msg_id)
+        entry = pending_requests.pop(msg_id, None)  # one atomic lookup, no check-then-pop race
+        if entry is not None:
+            plugin_req_id, req_method = entry
             result = msg.get("result")
             error = msg.get("error")
             if error:
@@ -158,232 +463,429 @@ def handle_lsp_message(msg: dict):
         return
 
     # Notification or server request
-    if method == "$/logTrace" or method == "$/progress":
-        return  # ignore verbose noise
-
-    if method == "window/logMessage":
-        params = msg.get("params", {})
-        log.debug("LSP logMessage [%s]: %s", params.get("type"), params.get("message", ""))
+    handler = _LSP_METHOD_HANDLERS.get(method)
+    if handler is not None:
+        handler(msg_id, msg.get("params", {}))
         return
 
-    if method == "window/showMessage":
-        params = msg.get("params", {})
-        write_resp({"type": "showMessage", "message": params.get("message", ""), "msgType": params.get("type", 3)})
-        return
+    log.debug("LSP unhandled method: %s (id=%s)", method, msg_id)
 
-    if method == "window/showMessageRequest":
-        params = msg.get("params", {})
-        log.info("LSP showMessageRequest: %s", params.get("message", ""))
-        write_resp({"type": "showMessageRequest", "id": str(msg_id), "message": params.get("message", ""), "msgType": params.get("type", 3), "actions": params.get("actions", [])})
-        # Auto-respond null so the server isn't blocked
-        lsp_send({"jsonrpc": "2.0", "id": msg_id, "result": None})
-        return
+    if msg_id is not None:
+        lsp_send({"jsonrpc": "2.0", "id": msg_id, "error": {"code": -32601, "message": "Method not found"}})
 
-    if method == "window/showDocument":
-        params = msg.get("params", {})
-        uri = params.get("uri", "")
-        write_resp({"type": "showDocument", "uri": uri})
-        lsp_send({"jsonrpc": "2.0", "id": msg_id, "result": {"success": True}})
-        return
 
-    if method == "workspace/configuration":
-        params = msg.get("params", {})
-        items = params.get("items", [])
-        lsp_send({"jsonrpc": "2.0", "id": msg_id, "result": [None] * len(items)})
-        return
+def _on_initialize(plugin_req_id, result):
+    lsp_notify("initialized", {})
+    write_resp({"type": "initialized", "id": plugin_req_id})
 
-    if method in ("copilot/didChangeStatus", "didChangeStatus", "statusNotification"):
-        params = msg.get("params", {})
-        write_resp({"type": "statusChanged", "message": params.get("message", ""), "kind": params.get("kind", "Normal")})
-        return
 
-    log.debug("LSP unhandled method: %s (id=%s)", method, msg_id)
+_COMPLETION_ITEM_KEYS = frozenset(("insertText", "range", "command"))
 
-    if msg_id is not None:
-        lsp_send({"jsonrpc": "2.0", "id": msg_id, "error": {"code": -32601, "message": "Method not found"}})
 
+def _on_inline_completion(plugin_req_id, result):
+    items = result.get("items", []) if result and isinstance(result, dict) else []
+    # Items carrying nothing beyond what we forward are passed through as-is
+    if not all(item.keys() <= _COMPLETION_ITEM_KEYS for item in items):
+        items = [{
+            "insertText": item.get("insertText", ""),
+            "range": item.get("range"),
+            "command": item.get("command"),
+        } for item in items]
+    write_resp({"type": "completionResult", "id": plugin_req_id, "items": items})
 
-def dispatch_lsp_response(method: str, plugin_req_id, result):
-    if method == "initialize":
-        lsp_notify("initialized", {})
-        write_resp({"type": "initialized", "id": plugin_req_id})
-        return
 
-    if method == "textDocument/inlineCompletion":
-        items = []
-        if result and isinstance(result, dict):
-            for item in result.get("items", []):
-                items.append({
-                    "insertText": item.get("insertText", ""),
-                    "range": item.get("range"),
-                    "command": item.get("command"),
-                })
-        write_resp({"type": "completionResult", "id": plugin_req_id, "items": items})
-        return
+def _on_sign_in(plugin_req_id, result):
+    if result:
+        write_resp({
+            "type": "signInResult",
+            "id": plugin_req_id,
+            "userCode": result.get("userCode", ""),
+            "verificationUri": result.get("verificationUri", ""),
+            "command": result.get("command"),
+        })
+    else:
+        write_resp({"type": "signInResult", "id": plugin_req_id, "userCode": "", "verificationUri": ""})
 
-    if method == "signIn":
-        if result:
-            write_resp({
-                "type": "signInResult",
-                "id": plugin_req_id,
-                "userCode": result.get("userCode", ""),
-                "verificationUri": result.get("verificationUri", ""),
-                "command": result.get("command"),
-            })
-        else:
-            write_resp({"type": "signInResult", "id": plugin_req_id, "userCode": "", "verificationUri": ""})
-        return
 
-    if method == "signOut":
-        write_resp({"type": "signOutResult", "id": plugin_req_id})
-        return
+def _on_sign_out(plugin_req_id, result):
+    write_resp({"type": "signOutResult", "id": plugin_req_id})
 
-    if method == "workspace/executeCommand":
-        write_resp({"type": "commandResult", "id": plugin_req_id, "result": result})
+
+def _on_execute_command(plugin_req_id, result):
+    write_resp({"type": "commandResult", "id": plugin_req_id, "result": result})
+
+
+# Responses to our requests, by the method that was requested
+_LSP_RESPONSE_HANDLERS = {
+    "initialize": _on_initialize,
+    "textDocument/inlineCompletion": _on_inline_completion,
+    "signIn": _on_sign_in,
+    "signOut": _on_sign_out,
+    "workspace/executeCommand": _on_execute_command,
+}
+
+
+def dispatch_lsp_response(method: str, plugin_req_id, result):
+    handler = _LSP_RESPONSE_HANDLERS.get(method)
+    if handler is not None:
+        handler(plugin_req_id, result)
         return
 
     write_resp({"type": "lspResponse", "id": plugin_req_id, "method": method, "result": result})
 
 
-def handle_plugin_message(msg: dict):
-    msg_type = msg.get("type")
-    req_id = msg.get("id")
-
-    if msg_type == "initialize":
-        workspace = msg.get("workspaceFolders", [])
-        process_id = os.getpid()  # use our own PID so the LSP server monitors us
-        lsp_request("initialize", {
-            "processId": process_id,
-            "clientInfo": {"name": "Fresh", "version": "1.0.0"},
-            "workspaceFolders": [{"uri": f"file://{w}"} for w in workspace],
-            "capabilities": {
-                "workspace": {
-                    "workspaceFolders": True,
-                    "configuration": True,
-                },
-                "textDocument": {
-                    "synchronization": {
-                        "dynamicRegistration": True,
-                        "didSave": True,
-                    },
-                    "inlineCompletion": {"dynamicRegistration": True},
-                    "inlayHint": {"dynamicRegistration": True},
-                },
+@functools.lru_cache(maxsize=None)
+def _workspace_uri(path: str) -> str:
+    # as_uri percent-encodes spaces and non-ASCII, which f"file://{path}" did not
+    return pathlib.Path(os.path.abspath(path)).as_uri()
+
+
+# The constant part of initialize, encoded once; only the id, our pid and the
+# workspace folders are filled in per call
+_INITIALIZE_TEMPLATE = (
+    b'{"jsonrpc":"2.0","id":%d,"method":"initialize","params":{"processId":%d,"workspaceFolders":%b,'
+    + _dumps({
+        "clientInfo": {"name": "Fresh", "version": "1.0.0"},
+        "capabilities": {
+            "workspace": {
+                "workspaceFolders": True,
+                "configuration": True,
             },
-            "initializationOptions": {
-                "editorInfo": {"name": "Fresh", "version": "1.0.0"},
-                "editorPluginInfo": {"name": "GitHub Copilot for Fresh", "version": "1.0.0"},
+            "textDocument": {
+                "synchronization": {
+                    "dynamicRegistration": True,
+                    "didSave": True,
+                },
+                "inlineCompletion": {"dynamicRegistration": True},
+                "inlayHint": {"dynamicRegistration": True},
             },
-        }, plugin_req_id=req_id)
-        return
+        },
+        "initializationOptions": {
+            "editorInfo": {"name": "Fresh", "version": "1.0.0"},
+            "editorPluginInfo": {"name": "GitHub Copilot for Fresh", "version": "1.0.0"},
+        },
+    })[1:]
+    + b"}"
+)
 
-    if msg_type == "configuration":
-        lsp_notify("workspace/didChangeConfiguration", {"settings": msg.get("settings", {})})
-        return
+# didChange is sent on every keystroke
+_DID_CHANGE_TEMPLATE = (
+    b'{"jsonrpc":"2.0","method":"textDocument/didChange","params":'
+    b'{"textDocument":{"uri":%b,"version":%b},"contentChanges":%b}}'
+)
 
-    if msg_type == "openDocument":
-        lsp_notify("textDocument/didOpen", {
-            "textDocument": {
-                "uri": msg["uri"],
-                "languageId": msg.get("languageId", "plaintext"),
-                "version": msg.get("version", 1),
-                "text": msg.get("text", ""),
-            }
-        })
-        return
 
-    if msg_type == "changeDocument":
-        lsp_notify("textDocument/didChange", {
-            "textDocument": {"uri": msg["uri"], "version": msg.get("version", 1)},
-            "contentChanges": msg.get("changes", []),
-        })
-        return
+def _plugin_initialize(msg, req_id):
+    folders = [{"uri": _workspace_uri(w)} for w in msg.get("workspaceFolders", [])]
+    lsp_id = _register_request("initialize", req_id)
+    # use our own PID so the LSP server monitors us
+    lsp_send_body(_INITIALIZE_TEMPLATE % (lsp_id, os.getpid(), _dumps(folders)), "initialize")
+
+
+def _plugin_configuration(msg, req_id):
+    lsp_notify("workspace/didChangeConfiguration", {"settings": msg.get("settings", {})})
+
+
+def _plugin_open_document(msg, req_id):
+    lsp_notify("textDocument/didOpen", {
+        "textDocument": {
+            "uri": msg["uri"],
+            "languageId": msg.get("languageId", "plaintext"),
+            "version": msg.get("version", 1),
+            "text": msg.get("text", ""),
+        }
+    })
+
+
+def _plugin_change_document(msg, req_id):
+    lsp_send_body(_DID_CHANGE_TEMPLATE % (
+        _dumps(msg["uri"]), _dumps(msg.get("version", 1)), _dumps(msg.get("changes", [])),
+    ), "textDocument/didChange")
+
+
+def _plugin_close_document(msg, req_id):
+    lsp_notify("textDocument/didClose", {
+        "textDocument": {"uri": msg["uri"]}
+    })
+
+
+def _plugin_focus_document(msg, req_id):
+    uri = msg.get("uri")
+    if uri:
+        lsp_notify("textDocument/didFocus", {"textDocument": {"uri": uri}})
+    else:
+        lsp_notify("textDocument/didFocus", {})
+
+
+def _plugin_inline_completion(msg, req_id):
+    lsp_request("textDocument/inlineCompletion", {
+        "textDocument": {"uri": msg["uri"], "version": msg.get("version", 0)},
+        "position": msg["position"],
+        "context": {"triggerKind": msg.get("triggerKind", 2)},
+        "formattingOptions": msg.get("formattingOptions", {"tabSize": 4, "insertSpaces": True}),
+    }, plugin_req_id=req_id)
+
+
+def _plugin_sign_in(msg, req_id):
+    lsp_request("signIn", {}, plugin_req_id=req_id)
+
+
+def _plugin_sign_out(msg, req_id):
+    lsp_request("signOut", {}, plugin_req_id=req_id)
+
+
+def _plugin_execute_command(msg, req_id):
+    lsp_request("workspace/executeCommand", {
+        "command": msg["command"],
+        "arguments": msg.get("arguments", []),
+    }, plugin_req_id=req_id)
 
-    if msg_type == "closeDocument":
-        lsp_notify("textDocument/didClose", {
-            "textDocument": {"uri": msg["uri"]}
+
+def _plugin_did_accept_completion(msg, req_id):
+    cmd = msg.get("command")
+    if cmd:
+        lsp_notify("workspace/executeCommand", {
+            "command": cmd.get("command"),
+            "arguments": cmd.get("arguments", []),
         })
-        return
 
-    if msg_type == "focusDocument":
-        uri = msg.get("uri")
-        if uri:
-            lsp_notify("textDocument/didFocus", {"textDocument": {"uri": uri}})
-        else:
-            lsp_notify("textDocument/didFocus", {})
-        return
 
-    if msg_type == "inlineCompletion":
-        lsp_request("textDocument/inlineCompletion", {
-            "textDocument": {"uri": msg["uri"], "version": msg.get("version", 0)},
-            "position": msg["position"],
-            "context": {"triggerKind": msg.get("triggerKind", 2)},
-            "formattingOptions": msg.get("formattingOptions", {"tabSize": 4, "insertSpaces": True}),
-        }, plugin_req_id=req_id)
-        return
+def _plugin_did_show_completion(msg, req_id):
+    lsp_notify("textDocument/didShowCompletion", {"item": msg.get("item", {})})
 
-    if msg_type == "signIn":
-        lsp_request("signIn", {}, plugin_req_id=req_id)
-        return
 
-    if msg_type == "signOut":
-        lsp_request("signOut", {}, plugin_req_id=req_id)
-        return
+_PLUGIN_HANDLERS = {
+    "initialize": _plugin_initialize,
+    "configuration": _plugin_configuration,
+    "openDocument": _plugin_open_document,
+    "changeDocument": _plugin_change_document,
+    "closeDocument": _plugin_close_document,
+    "focusDocument": _plugin_focus_document,
+    "inlineCompletion": _plugin_inline_completion,
+    "signIn": _plugin_sign_in,
+    "signOut": _plugin_sign_out,
+    "executeCommand": _plugin_execute_command,
+    "didAcceptCompletion": _plugin_did_accept_completion,
+    "didShowCompletion": _plugin_did_show_completion,
+}
 
-    if msg_type == "executeCommand":
-        lsp_request("workspace/executeCommand", {
-            "command": msg["command"],
-            "arguments": msg.get("arguments", []),
-        }, plugin_req_id=req_id)
-        return
 
-    if msg_type == "didAcceptCompletion":
-        cmd = msg.get("command")
-        if cmd:
-            lsp_notify("workspace/executeCommand", {
-                "command": cmd.get("command"),
-                "arguments": cmd.get("arguments", []),
-            })
+def handle_plugin_message(msg: dict):
+    msg_type = msg.get("type")
+    handler = _PLUGIN_HANDLERS.get(msg_type)
+    if handler is None:
+        log.debug("Unknown plugin message type: %s", msg_type)
         return
+    handler(msg, msg.get("id"))
 
-    if msg_type == "didShowCompletion":
-        lsp_notify("textDocument/didShowCompletion", {"item": msg.get("item", {})})
-        return
 
-    log.debug("Unknown plugin message type: %s", msg_type)
+# inotify(7) constants
+IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x2, 0x8, 0x80, 0x100
+IN_Q_OVERFLOW = 0x4000
 
+# How long cmd may stay shorter than what we already read before we treat it
+# as a real truncation rather than the plugin mid-way through rewriting it
+CMD_SHRINK_SETTLE = 0.05
 
-def cmd_file_watcher():
-    cmd_path = os.path.join(ipc_dir, "cmd")
-    last_pos = 0
 
-    while not shutdown_event.is_set():
-        time.sleep(0.05)
+def _dispatch_cmd_line(line):
+    if line.strip():
         try:
-            if not os.path.exists(cmd_path):
-                continue
-            with open(cmd_path, "r") as f:
-                f.seek(last_pos)
-                new_data = f.read()
-                last_pos = f.tell()
-
-            if not new_data:
-                try:
-                    size = os.path.getsize(cmd_path)
-                    if size < last_pos:
-                        last_pos = 0
-                except OSError:
-                    pass
-                continue
-
-            for line in new_data.strip().split("\n"):
-                if line.strip():
-                    try:
-                        handle_plugin_message(json.loads(line))
-                    except (json.JSONDecodeError, KeyError) as e:
-                        log.error("IPC parse error: %s - %r", e, line[:80])
+            handle_plugin_message(_loads(line))
+        except (json.JSONDecodeError, UnicodeDecodeError, KeyError) as e:
+            log.error("IPC parse error: %s - %r", e, line[:80])
+        except Exception:
+            log.exception("Failed to handle plugin message: %r", line[:80])
+
+
+def _inotify_watch(path: str, mask: int):
+    """Return an inotify fd watching path, or None where inotify is unavailable."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        # IN_NONBLOCK and IN_CLOEXEC share the O_ flag values; os only has
+        # O_CLOEXEC on POSIX, so look it up past the Linux check
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _read_inotify_mask(fd: int, name: bytes) -> int:
+    """Drain pending events and return the OR of the masks reported for name."""
+    result = 0
+    while True:
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return result
+        off = 0
+        while off < len(data):
+            _wd, mask, _cookie, n = struct.unpack_from("iIII", data, off)
+            if mask & IN_Q_OVERFLOW or data[off + 16:off + 16 + n].rstrip(b"\0") == name:
+                result |= mask
+            off += 16 + n
+
+
+class CmdReader:
+    """Dispatches the lines appended to cmd since the last check."""
+
+    def __init__(self, path: str, keep_open: bool):
+        self.path = path
+        # Holding cmd open saves an open per check, but on Windows it would
+        # stop the plugin from replacing the file, so polling reopens it
+        self.keep_open = keep_open
+        self.fd = -1
+        self.ident = None  # (st_dev, st_ino) of the file self.fd refers to
+        self.pos = 0
+        self.pending = bytearray()  # trailing partial line
+        self.shrunk_at = None
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def _size(self) -> int:
+        st = os.stat(self.path)
+        if self.fd < 0 or (st.st_dev, st.st_ino) != self.ident:
+            # first look at cmd, or a new file has taken its name
+            self.close()
+            self.fd = os.open(self.path, os.O_RDONLY | getattr(os, "O_CLOEXEC", 0) | getattr(os, "O_BINARY", 0))
+            st = os.fstat(self.fd)
+            self.ident = (st.st_dev, st.st_ino)
+        return st.st_size
+
+    def _read(self, size: int) -> bytes:
+        if hasattr(os, "pread"):
+            return os.pread(self.fd, size - self.pos, self.pos)
+        os.lseek(self.fd, self.pos, os.SEEK_SET)
+        return os.read(self.fd, size - self.pos)
+
+    def check(self) -> bool:
+        """Dispatch any new complete lines; True while a shrink is waiting to settle."""
+        try:
+            size = self._size()
+            if size < self.pos:
+                # The plugin rewrites cmd in full, so it is briefly shorter while
+                # being written; only a file that stays short was really truncated
+                now = time.monotonic()
+                if self.shrunk_at is None:
+                    self.shrunk_at = now
+                if now - self.shrunk_at < CMD_SHRINK_SETTLE:
+                    return True
+                self.pos = 0
+                self.pending.clear()
+            self.shrunk_at = None
+            if size == self.pos:
+                return False
+            data = self._read(size)
         except OSError:
-            continue
+            return False
+        finally:
+            if not self.keep_open:
+                self.close()
+
+        self.pos += len(data)
+        self.pending += data
+        end = self.pending.rfind(b"\n") + 1
+        if end:
+            lines = bytes(self.pending[:end]).split(b"\n")
+            del self.pending[:end]
+            with lsp_batch():  # one flush for everything this check forwards
+                for line in lines:
+                    _dispatch_cmd_line(line)
+        return False
+
+
+CMD_POLL_INTERVAL = 0.05  # without inotify
+
+
+def io_loop(proc):
+    """Serves the server's stdout and stdin and the plugin's cmd file from one thread."""
+    cmd_path = os.path.join(ipc_dir, "cmd")
+    lsp = LspReader(proc.stdout.raw)
+
+    if os.name == "nt":
+        # select() on Windows only takes sockets, so the pipes keep their own
+        # threads and cmd is polled
+        threading.Thread(target=lsp.run, daemon=True).start()
+        threading.Thread(target=stdin_writer, args=(proc,), daemon=True).start()
+        cmd = CmdReader(cmd_path, keep_open=False)
+        while not shutdown_event.is_set():
+            time.sleep(CMD_POLL_INTERVAL)
+            cmd.check()
+        return
+
+    # Every lsp_send comes from a handler called below, so the frames they
+    # queue are flushed at the end of the same iteration
+    stdin = StdinPipe(proc.stdin.fileno())
+    sel = selectors.DefaultSelector()
+    sel.register(proc.stdout.fileno(), selectors.EVENT_READ, "lsp")
+    # Linux: sleep until the kernel reports a change to cmd; elsewhere, poll
+    inotify_fd = _inotify_watch(ipc_dir, IN_MODIFY | IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO)
+    if inotify_fd is not None:
+        log.debug("Watching %s with inotify", cmd_path)
+        sel.register(inotify_fd, selectors.EVENT_READ, "cmd")
+    cmd = CmdReader(cmd_path, keep_open=inotify_fd is not None)
+    cmd_name = os.fsencode("cmd")
+    settling = False
+    writing = False  # stdin registered for EVENT_WRITE
+    next_poll = time.monotonic()
+
+    try:
+        while not shutdown_event.is_set():
+            if settling:
+                timeout = CMD_SHRINK_SETTLE
+            elif inotify_fd is not None:
+                timeout = 1.0
+            else:
+                timeout = max(0.0, next_poll - time.monotonic())
+            check_cmd = settling
+            for key, _ in sel.select(timeout):
+                if key.data == "lsp":
+                    if not lsp.read_once():
+                        sel.unregister(key.fd)
+                        _lsp_stdout_closed()
+                elif key.data == "cmd" and _read_inotify_mask(inotify_fd, cmd_name):
+                    check_cmd = True
+            if inotify_fd is None and time.monotonic() >= next_poll:
+                check_cmd = True
+                next_poll = time.monotonic() + CMD_POLL_INTERVAL
+            if check_cmd:
+                settling = cmd.check()
+            stdin.take()
+            if stdin.flush() != writing:
+                writing = not writing
+                if writing:
+                    sel.register(stdin.fd, selectors.EVENT_WRITE, "stdin")
+                else:
+                    sel.unregister(stdin.fd)
+    finally:
+        sel.close()
+        cmd.close()
+        if inotify_fd is not None:
+            os.close(inotify_fd)
+
+
+PR_SET_PDEATHSIG = 1
+
+
+def _set_parent_death_signal(sig) -> bool:
+    """Ask the kernel to send sig when our parent goes away (Linux only)."""
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.prctl(PR_SET_PDEATHSIG, int(sig), 0, 0, 0) == 0
+    except (OSError, AttributeError):
+        return False
 
 
 def parent_watcher(parent_pid):
@@ -413,28 +915,47 @@ def main():
     log.info("Server binary: %s", server_binary)
     log.info("Workspace: %s", workspace)
 
-    threading.Thread(target=parent_watcher, args=(parent_pid,), daemon=True).start()
+    def on_parent_death(signum, frame):
+        # Sent when the thread that spawned us exits, which need not be the
+        # whole editor; only being reparented means the parent is gone
+        if os.getppid() != parent_pid:
+            log.info("Parent %d exited, shutting down", parent_pid)
+            shutdown_event.set()
 
-    xdg_cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
-    ipc_base = os.path.join(xdg_cache, "fresh", "copilot-ipc")
-    os.makedirs(ipc_base, exist_ok=True)
+    signal.signal(signal.SIGTERM, lambda signum, frame: shutdown_event.set())
+    death_sig = getattr(signal, "SIGUSR1", None)  # not on Windows
+    if death_sig is not None:
+        # must be in place before prctl, the default action would kill us
+        signal.signal(death_sig, on_parent_death)
+        if _set_parent_death_signal(death_sig):
+            on_parent_death(death_sig, None)  # the parent may have exited before prctl
+        else:
+            signal.signal(death_sig, signal.SIG_DFL)
+            death_sig = None
+    if death_sig is None:
+        threading.Thread(target=parent_watcher, args=(parent_pid,), daemon=True).start()
 
-    ipc_dir = os.path.join(ipc_base, str(os.getpid()))
-    os.makedirs(ipc_dir, exist_ok=True)
+    fresh_cache = _get_fresh_cache_dir()
+    ipc_dir = os.path.join(fresh_cache, "copilot-ipc", str(os.getpid()))
+    os.makedirs(ipc_dir, exist_ok=True)  # creates copilot-ipc too
 
     with open(port_file, "w") as f:
         f.write(ipc_dir)
 
     log.info("IPC directory: %s", ipc_dir)
 
+    # Nothing reads the server's stderr, so a pipe would eventually fill and
+    # block it mid-write; send it to a log file next to ours instead
+    stderr_path = os.path.join(fresh_cache, "copilot-lsp-stderr.log")
     try:
-        lsp_process = subprocess.Popen(
-            [server_binary, "--stdio"],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            cwd=workspace,
-        )
+        with open(stderr_path, "ab") as stderr_fp:
+            lsp_process = subprocess.Popen(
+                [server_binary, "--stdio"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=stderr_fp,
+                cwd=workspace,
+            )
     except (FileNotFoundError, PermissionError) as e:
         log.error("Failed to start Copilot Language Server: %s", e)
         with open(port_file, "w") as f:
@@ -443,9 +964,10 @@ def main():
 
     log.info("Copilot Language Server started (pid=%d)", lsp_process.pid)
 
-    threading.Thread(target=read_lsp_messages, daemon=True).start()
+    threading.Thread(target=io_loop, args=(lsp_process,), daemon=True).start()
 
-    threading.Thread(target=cmd_file_watcher, daemon=True).start()
+    writer = threading.Thread(target=resp_writer, daemon=True)
+    writer.start()
 
     write_resp({"type": "ready"})
 
@@ -455,7 +977,7 @@ def main():
                 log.info("Copilot Language Server exited (code=%d)", lsp_process.returncode)
                 write_resp({"type": "serverStopped"})
                 break
-            time.sleep(1)
+            shutdown_event.wait(1)
     except KeyboardInterrupt:
         pass
     finally:
@@ -466,12 +988,12 @@ def main():
                 lsp_process.wait(timeout=3)
             except subprocess.TimeoutExpired:
                 lsp_process.kill()
-        try:
-            for fn in os.listdir(ipc_dir):
-                os.remove(os.path.join(ipc_dir, fn))
-            os.rmdir(ipc_dir)
-        except OSError:
-            pass
+        resp_queue.put(None)
+        writer.join(timeout=1)
+        with resp_lock:
+            if resp_fp is not None:
+                resp_fp.close()
+        shutil.rmtree(ipc_dir, ignore_errors=True)
         log.info("Copilot bridge stopped")
 
 